@@ -12,19 +12,23 @@ python version 3.12
 # Standard Python modules
 # =============================================================================
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 import logging
 import os
 import json 
-from typing import Dict, Literal
+from typing import Dict, Literal, Optional, Tuple
 
 # =============================================================================
 # External Python modules
 # =============================================================================
-import fiona
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel
+import pyogrio
 import rapidfuzz
+import shapely
 
 # =============================================================================
 # Extension modules
@@ -39,6 +43,10 @@ logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=lo
 PATH_CACHE_DIR = "./georef_cache/"
 os.makedirs(PATH_CACHE_DIR, exist_ok=True)
 PATH_CACHE_META = "./georef_cache/META.json"
+# cache files are only ever written and read back whole, no need for gpkg
+CACHE_SUFFIX = ".parquet"
+# features per chunk when streaming the input file
+CHUNK_SIZE = 100_000
 
 STATE_MAPPING = {
         "city_extracted":1,
@@ -54,6 +62,16 @@ class MetaDictCity(BaseModel):
     filename_city:str
     filename_boundaries_within:str
     filename_all_mp_within:str
+    # only the georef_use_type column of all_mp_within (keyed by its index), 
+    #   written in step 3 so the full multipolygons are never rewritten
+    filename_use_type:str
+    # bbox (minx, miny, maxx, maxy) of the city in the crs of the input file,
+    #   optional since older caches dont have it
+    bbox:Optional[Tuple[float, float, float, float]] = None
+    # the cached geometries went through make_valid already in step 1
+    valid:bool = True
+    # area of the city boundary, so logging it doesnt require reading the cache
+    area_m2:float
 
 class MetaDict(BaseModel):
     cities:Dict[str,MetaDictCity]
@@ -92,11 +110,44 @@ class GeoStat():
 
 
     def _debug_print_layers(self):
-        logging.debug(f"layers in input file: {fiona.listlayers(self.path_in)}")
+        logging.debug(f"layers in input file: {pyogrio.list_layers(self.path_in)[:, 0]}")
 
-    def get_gdf(self, layer="multipolygons"):
-        logging.info("reading file (could take a second)")
-        gdf = gpd.read_file(self.path_in, layer=layer)
+    def _iter_gdf(self, layer="multipolygons", bbox=None, columns=None):
+        """ yields the layer in record batches of CHUNK_SIZE features from a 
+        single arrow reader, so only one chunk at a time has to fit in RAM
+        """
+        with pyogrio.open_arrow(
+                self.path_in,
+                layer=layer,
+                bbox=bbox,
+                columns=columns,
+                batch_size=CHUNK_SIZE,
+                use_pyarrow=True
+        ) as (meta, reader):
+            for batch in reader:
+                chunk = gpd.GeoDataFrame.from_arrow(batch)
+                # same geometry column name as get_gdf_sqlite
+                if chunk.geometry.name != "geometry":
+                    chunk = chunk.rename_geometry("geometry")
+                yield chunk
+
+    def get_gdf(self, city_id, layer="multipolygons"):
+        """ same result as get_gdf_sqlite, but without the need for spatialite:
+        streams everything within the city's bbox chunk by chunk and only 
+        keeps what the city covers
+        """
+        logging.info("reading file in chunks (could take a second)")
+        info = pyogrio.read_info(self.path_in, layer=layer)
+        columns = [c for c in self.processor.USED_COLUMNS if c in info["fields"]]
+        city = pyogrio.read_dataframe(self.path_in, layer=layer, fids=[city_id], columns=[])
+        city_geom = city.geometry.iloc[0]
+        shapely.prepare(city_geom)
+        survivors = []
+        for chunk in self._iter_gdf(layer, bbox=tuple(city.total_bounds), columns=columns):
+            covered = chunk[chunk.covered_by(city_geom)]
+            logging.debug(f"kept {len(covered)} of {len(chunk)} in chunk")
+            survivors.append(self.processor.prepare_columns(covered))
+        gdf = gpd.GeoDataFrame(pd.concat(survivors, ignore_index=True), crs=city.crs)
         logging.debug(f"columns: {gdf.columns}")
         logging.debug(f"CRS: {gdf.crs}")
         logging.debug(f"#rows: {len(gdf)}")
@@ -104,14 +155,7 @@ class GeoStat():
 
     def get_gdf_sqlite(self, city_id, layer="multipolygons"):
         logging.info("reading file using sqlite filtering")
-        boundaries = self.processor.within_boundary_rtree(self.path_in, city_id, layer)
-        id_list = ",".join(map(str, [x[0] for x in boundaries]))
-        logging.debug(f"len of prefilterd polygon list: {len(id_list)}")
-        gdf = gpd.read_file(
-                self.path_in, 
-                layer=layer,
-                engine="pyogrio",
-                where=f'"{self.processor.PK_COLUMN}" IN ({id_list})')
+        gdf = self.processor.fetch_multipolygons_within(self.path_in, city_id, layer)
         logging.debug(f"columns: {gdf.columns}")
         logging.debug(f"CRS: {gdf.crs}")
         logging.debug(f"#rows: {len(gdf)}")
@@ -124,19 +168,42 @@ class GeoStat():
         if city_name not in self.cache_meta.cities:
             return None
         mdc = self.cache_meta.cities.get(city_name, None)
+        # caches written before the switch to parquet are simply rebuilt
+        if os.path.splitext(mdc.filename_city)[-1] != CACHE_SUFFIX:
+            logging.info(f"cache for {city_name} is outdated, ignoring it")
+            return None
         return mdc.state
 
+    def _write_cache(self, gdf, path):
+        gdf.to_parquet(path)
+
+    def _read_cache(self, path):
+        return gpd.read_parquet(path)
+
     def _get_cache_filepaths(self, name):
-        city_path = os.path.join(PATH_CACHE_DIR, f"{name}_city.gpkg")
-        boundaries_within_path = os.path.join(PATH_CACHE_DIR, f"{name}_boundaries_within.gpkg")
-        all_mp_within_path = os.path.join(PATH_CACHE_DIR, f"{name}_all_mp_within.gpkg")
-        return city_path, boundaries_within_path, all_mp_within_path
+        city_path = os.path.join(PATH_CACHE_DIR, f"{name}_city{CACHE_SUFFIX}")
+        boundaries_within_path = os.path.join(PATH_CACHE_DIR, f"{name}_boundaries_within{CACHE_SUFFIX}")
+        all_mp_within_path = os.path.join(PATH_CACHE_DIR, f"{name}_all_mp_within{CACHE_SUFFIX}")
+        use_type_path = os.path.join(PATH_CACHE_DIR, f"{name}_use_type{CACHE_SUFFIX}")
+        return city_path, boundaries_within_path, all_mp_within_path, use_type_path
+
+    def cache_get_bbox(self, city_name):
+        mdc = self.cache_meta.cities.get(city_name, None)
+        if mdc is None:
+            return None
+        return mdc.bbox
+
+    def fetch_boundaries_only(self, bbox=None):
+        return self.processor.fetch_boundaries_only(self.path_in, bbox=bbox)
 
-    def fetch_boundaries_only(self):
-        return self.processor.fetch_boundaries_only(self.path_in)
+    def _centroid_within(self, gdf, geom):
+        # point in polygon on plain coordinate arrays, GEOS indexes geom once 
+        # instead of testing one centroid geometry after another
+        pts = shapely.centroid(gdf.geometry.values)
+        return shapely.contains_xy(geom, shapely.get_x(pts), shapely.get_y(pts))
 
     def extract_city(self, name, gdf):
-        """This extracts, saves in self and caches as gpkg:
+        """This extracts, saves in self and caches as parquet:
 
         self.city_m : administrative boundary of the city 
 
@@ -144,6 +211,9 @@ class GeoStat():
 
         self.all_mp_within : all multipolygons that are mostly self.city_m and 
             not administrative boundaries
+
+        gdf is expected to be prefiltered to the city already (see 
+        get_gdf_sqlite), it is not clipped to the city here again
         """
         known_admin_boundaries =self.processor.get_all_admin_boundaries(gdf)
         logging.debug(f"admin boundaries: {len(known_admin_boundaries)}")
@@ -157,7 +227,6 @@ class GeoStat():
         candidates["area_m2"] = candidates_m.area
         city = candidates.sort_values("area_m2", ascending=False).iloc[[0]].copy()
         #self.name = self.city.name.iloc[0]
-        admin_m = known_admin_boundaries.to_crs(25832)
         city_m = city.to_crs(25832)
         city_area = float(city_m.iloc[0]['area_m2'])
         logging.info(f"admin border (level {city_m.iloc[0]['admin_level']}) picked has area {city_area}")
@@ -165,16 +234,19 @@ class GeoStat():
 
         ## get sub boundaries
 
-        others = admin_m[admin_m.index != city_m.index[0]].copy()
+        others = known_admin_boundaries[known_admin_boundaries.index != city.index[0]]
         logging.debug(f"sub-b_0: {len(others)}")
-        bbox = city_m.total_bounds #minx miny maxx maxy
+        bbox_og_crs = city.total_bounds #minx miny maxx maxy
 
-        others = others.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+        # prefilter in the orig crs, so only the remaining few get reprojected.
+        # this is the only spatial query left here, building an STRtree just 
+        # for it costs more than the O(n) bbox slice
+        others = others.cx[bbox_og_crs[0]:bbox_og_crs[2], bbox_og_crs[1]:bbox_og_crs[3]].to_crs(25832)
         boundaries_within = others[others.intersects(city_m.geometry.iloc[0])].copy()
         logging.debug(f"sub-b_1: {len(boundaries_within)}")
         boundaries_within["area_m2"] = boundaries_within.area
         boundaries_within = boundaries_within[
-                (boundaries_within.centroid.within(city_m.geometry.iloc[0])) &
+                (self._centroid_within(boundaries_within, city_m.geometry.iloc[0])) &
                 (boundaries_within["area_m2"]<=city_area) &
                 (self.processor.is_admin_level_subcity(boundaries_within))
         ].copy()
@@ -185,29 +257,28 @@ class GeoStat():
 
         ## get all non-boundary multipolygons (mostly) within city limits
 
-        bbox_og_crs = city.total_bounds
-        # I use the orig crs to save RAM
-        all_polygons = gdf.cx[bbox_og_crs[0]:bbox_og_crs[2], bbox_og_crs[1]:bbox_og_crs[3]]
-        # I reproject the intersects view, creating a copy without explicitly calling .copy()
-        all_mp_within = all_polygons[all_polygons.intersects(city.geometry.iloc[0])].to_crs(25832)
-        # now I need to switch from city to city_m
+        all_mp_within = gdf.to_crs(25832)
         all_mp_within["area_m2"] = all_mp_within.area
         all_mp_within = all_mp_within[
-                (all_mp_within.centroid.within(city_m.geometry.iloc[0])) &
+                (self._centroid_within(all_mp_within, city_m.geometry.iloc[0])) &
                 (all_mp_within["area_m2"]<=city_area) &
                 (self.processor.not_admin_boundary(all_mp_within))
         ].copy()
         logging.info(f"extracted {len(all_mp_within)} multipolygons within city boundaries")
+        # validated once here and cached like that, later steps rely on it 
+        # (see MetaDictCity.valid)
+        for gdf_m in [city_m, boundaries_within, all_mp_within]:
+            gdf_m["geometry"] = gdf_m.geometry.make_valid()
 
         ## save and cache 
 
-        cp, wp, ap = self._get_cache_filepaths(self.name)
-        logging.info("caching filtered gpkg")
-        city_m.to_file(cp, driver="GPKG")
+        cp, wp, ap, up = self._get_cache_filepaths(self.name)
+        logging.info("caching filtered multipolygons")
+        self._write_cache(city_m, cp)
         self.city_m = city_m
-        boundaries_within.to_file(wp, driver="GPKG")
+        self._write_cache(boundaries_within, wp)
         self.boundaries_within = boundaries_within
-        all_mp_within.to_file(ap, driver="GPKG")
+        self._write_cache(all_mp_within, ap)
         self.all_mp_within = all_mp_within
 
         self.cache_meta.cities[self.name] = MetaDictCity(
@@ -215,25 +286,43 @@ class GeoStat():
                 filename_city = cp,
                 filename_boundaries_within = wp,
                 filename_all_mp_within = ap,
+                filename_use_type = up,
+                bbox = tuple(bbox_og_crs.tolist()),
+                valid = True,
+                area_m2 = city_area,
                 state="city_extracted"
         )
         self._dump_meta()
 
     def load_cached_mp(self, name):
-        """ mirrors extract_city, but loads the data from cache
+        """ mirrors extract_city, but the data is only read from cache once a 
+        later step actually needs it (see the cached properties below)
         """
         logging.info("reading from cache")
         self.name = name
         mdc = self.cache_meta.cities.get(name, None)
         if mdc is None:
             raise ValueError("did the cache vanish or what?")
-        self.city_m = gpd.read_file(mdc.filename_city)
-        logging.info(f"admin border loaded has area {float(self.city_m.iloc[0]['area_m2'])}")
-        self.boundaries_within = gpd.read_file(mdc.filename_boundaries_within)
-        self.processor.set_subcity_admin_level(self.boundaries_within, self.city_m)
-        logging.info(f"loaded {len(self.boundaries_within)} sub boundaries")
-        self.all_mp_within = gpd.read_file(mdc.filename_all_mp_within)
-        logging.info(f"loaded {len(self.all_mp_within)} multipolygons within city boundaries")
+        logging.info(f"admin border cached has area {mdc.area_m2}")
+
+    @cached_property
+    def city_m(self):
+        return self._read_cache(self.cache_meta.cities[self.name].filename_city)
+
+    @cached_property
+    def boundaries_within(self):
+        boundaries_within = self._read_cache(self.cache_meta.cities[self.name].filename_boundaries_within)
+        logging.info(f"loaded {len(boundaries_within)} sub boundaries")
+        return boundaries_within
+
+    @cached_property
+    def all_mp_within(self):
+        mdc = self.cache_meta.cities[self.name]
+        all_mp_within = self._read_cache(mdc.filename_all_mp_within)
+        if STATE_MAPPING[mdc.state] >= STATE_MAPPING["use_type_added"]:
+            all_mp_within = all_mp_within.join(pd.read_parquet(mdc.filename_use_type))
+        logging.info(f"loaded {len(all_mp_within)} multipolygons within city boundaries")
+        return all_mp_within
 
     # step 2 - "fix" sub boundaries
 
@@ -242,8 +331,7 @@ class GeoStat():
         mdc = self.cache_meta.cities.get(self.name, None)
         if mdc is None:
             raise ValueError("fr, why is there no cache at his point?")
-        city_m_geom = self.city_m.geometry.make_valid().iloc[0]
-        self.boundaries_within["geometry"] = self.boundaries_within.geometry.make_valid()
+        city_m_geom = self.city_m.geometry.iloc[0]
         boundaries_union = self.boundaries_within.geometry.union_all()
         boundaries_union = boundaries_union.intersection(city_m_geom)
         rest_geom = city_m_geom.difference(boundaries_union)
@@ -251,19 +339,21 @@ class GeoStat():
             logging.debug("nothing to fix, empty rest area")
         else:
             logging.debug(f"fixing, rest has an area of {rest_geom.area}")
-            # add to boundaries_within
-            tmp = self.boundaries_within.iloc[[0]].copy()
-            tmp["name"] = "Restgebiet"
+            # add to boundaries_within, with the first row's attributes. a 1-row
+            # slice rather than a dict, so the column dtypes stay as cached
+            rest = self.boundaries_within.iloc[[0]].copy()
+            # .loc[:, col] writes into the existing columns instead of 
+            # replacing them with new (object) ones
+            rest.loc[:, "name"] = "Restgebiet"
             for colname in ["id", "osm_id"]:
-                if colname in tmp.columns:
-                    tmp[colname] = None
-            tmp["geometry"] = rest_geom
-
-            self.boundaries_within = gpd.GeoDataFrame(
-                    pd.concat([self.boundaries_within, tmp], ignore_index=True),
-                    crs = self.boundaries_within.crs
-            )
-            self.boundaries_within.to_file(mdc.filename_boundaries_within)
+                if colname in rest.columns:
+                    rest.loc[:, colname] = None
+            if "area_m2" in rest.columns:
+                rest.loc[:, "area_m2"] = rest_geom.area
+            rest.loc[:, "geometry"] = rest_geom
+            # concat of two GeoDataFrames keeps the crs, no copy into a new one
+            self.boundaries_within = pd.concat([self.boundaries_within, rest], ignore_index=True)
+            self._write_cache(self.boundaries_within, mdc.filename_boundaries_within)
         mdc.state = "boundaries_fixed"
         self._dump_meta()
 
@@ -272,27 +362,26 @@ class GeoStat():
         mdc = self.cache_meta.cities.get(self.name, None)
         if mdc is None:
             raise ValueError("frfr, why is there no cache at his point?")
-        self.all_mp_within["georef_use_type"] = self.all_mp_within.apply(
-                self.processor.classify_use, 
-                axis=1
-            )
+        self.all_mp_within["georef_use_type"] = self.processor.classify_use(self.all_mp_within)
         logging.debug(self.all_mp_within["georef_use_type"].value_counts(dropna=False))
-        self.all_mp_within.to_file(mdc.filename_all_mp_within)
+        self.all_mp_within[["georef_use_type"]].to_parquet(mdc.filename_use_type)
         mdc.state = "use_type_added"
         self._dump_meta()
 
     def compute_statistics(self):
         prio_list = self.processor.get_use_priority()
-        use_type_unions = dict()
-        self.all_mp_within["geometry"] = self.all_mp_within.geometry.make_valid()
-        full_union = self.all_mp_within.geometry.union_all()
-        full_area = full_union.area
-        for prio in prio_list:
-            part = self.all_mp_within[self.all_mp_within["georef_use_type"] == prio]
-            if len(part) == 0:
-                use_type_unions[prio] = None
-            else:
-                use_type_unions[prio] = part.geometry.union_all()
+        # one pass over the use types instead of one filtered copy per prio
+        groups = {
+                prio: part.geometry.to_numpy()
+                for prio, part in self.all_mp_within.groupby("georef_use_type", observed=True)
+        }
+        # GEOS releases the GIL, so the unions of the use types run in parallel
+        with ThreadPoolExecutor(max_workers=len(prio_list)) as executor:
+            unions = dict(executor.map(
+                    lambda prio: (prio, shapely.unary_union(groups[prio])),
+                    groups
+            ))
+        use_type_unions = {prio: unions.get(prio) for prio in prio_list}
 
         diffed_areas = dict()
         higher_prio_union = None
@@ -306,42 +395,54 @@ class GeoStat():
                 higher_prio_union = geom
             else:
                 diffed_areas[prio] = geom.difference(higher_prio_union)
-                higher_prio_union = higher_prio_union.union(geom)
-
-        # compute statistics for each sub boundary
-        def _get_area_dict(geom):
-            ret = dict()
-            # we use diffed_areas and priority from surrounding scope
-            remaining = geom.area
-            computed_total = 0
-            for prio in prio_list:
-                d_geom = diffed_areas[prio]
-                if d_geom is None:
-                    ret[prio] = 0.0
-                    continue
-
-                area = geom.intersection(d_geom).area
-                ret[prio] = area
-                computed_total += area
-                remaining -= area
-            null_area = max(0.0, remaining)
-            if "null" in ret:
-                ret["null"] += null_area
-            else:
-                ret["null"] = null_area
-            ret["total_area"] = geom.area
-            return ret
-
-        main = _get_area_dict(full_union)
-        main["name"] = f"all ({self.name})"
-        stat_rows = [main]
-        for i, row in self.boundaries_within.iterrows():
-            sub_name = row["name"]
-            sub_geom = row.geometry
-            rec = _get_area_dict(sub_geom)
-            rec["name"] = sub_name
-            stat_rows.append(rec)
-        stats_df = pd.DataFrame(stat_rows)
+                higher_prio_union = shapely.unary_union([higher_prio_union, geom])
+        # every row has a use type, so the union of all of them is the full union
+        full_area = higher_prio_union.area if higher_prio_union is not None else 0.0
+
+        # the diffed areas dont overlap, so their single parts can go into one
+        # STRtree and only parts crossing a sub boundary need to be clipped
+        parts = []
+        part_codes = []
+        for code, prio in enumerate(prio_list):
+            if diffed_areas[prio] is None:
+                continue
+            p = shapely.get_parts(diffed_areas[prio])
+            parts.append(p)
+            part_codes.append(np.full(len(p), code))
+        parts = np.concatenate(parts) if parts else np.empty(0, dtype=object)
+        part_codes = np.concatenate(part_codes) if part_codes else np.empty(0, dtype=int)
+        part_areas = shapely.area(parts)
+        tree = shapely.STRtree(parts)
+
+        # compute statistics for all sub boundaries at once, one row per 
+        # (sub boundary, part) pair the tree finds
+        subs = self.boundaries_within.geometry.to_numpy()
+        shapely.prepare(subs)
+        sub_idx, part_idx = tree.query(subs, predicate="intersects")
+        inside = shapely.contains_properly(subs[sub_idx], parts[part_idx])
+        areas = part_areas[part_idx]
+        areas[~inside] = shapely.area(
+                shapely.intersection(parts[part_idx[~inside]], subs[sub_idx[~inside]])
+        )
+        sub_prio_areas = np.bincount(
+                sub_idx * len(prio_list) + part_codes[part_idx],
+                weights=areas,
+                minlength=len(subs) * len(prio_list)
+        ).reshape(len(subs), len(prio_list))
+
+        # every part lies within the full union, no clipping needed
+        main_prio_areas = np.bincount(part_codes, weights=part_areas, minlength=len(prio_list))
+
+        prio_areas = np.vstack([main_prio_areas, sub_prio_areas])
+        total_areas = np.concatenate([[full_area], shapely.area(subs)])
+        stats_df = pd.DataFrame(prio_areas, columns=prio_list)
+        null_area = np.maximum(0.0, total_areas - prio_areas.sum(axis=1))
+        if "null" in stats_df.columns:
+            stats_df["null"] += null_area
+        else:
+            stats_df["null"] = null_area
+        stats_df["total_area"] = total_areas
+        stats_df["name"] = [f"all ({self.name})"] + self.boundaries_within["name"].tolist()
         for prio in prio_list:
             stats_df[f"{prio}_pct"] = (stats_df[prio] / stats_df["total_area"])*100.0
         stats_df = stats_df.round(2)
@@ -359,15 +460,25 @@ def main():
     args = parser.parse_args() # parses cmd-line args
     
     c = GeoStat(args.inputfile, ProcessorOSM())
-    names_to_levels_ids = c.fetch_boundaries_only()
     city_name = input("Stadtname (wie in OSM, case sensitive): ").strip()
+    # for a city we know already, only boundaries around it are needed
+    bbox = c.cache_get_bbox(city_name)
+    names_to_levels_ids = c.fetch_boundaries_only(bbox=bbox)
+    if city_name not in names_to_levels_ids and bbox is not None:
+        names_to_levels_ids = c.fetch_boundaries_only()
     if city_name not in names_to_levels_ids:
+        # score_cutoff lets rapidfuzz skip hopeless names early instead of 
+        # fully scoring every boundary name in the file
         e = rapidfuzz.process.extract(
                 city_name, 
-                names_to_levels_ids.keys(), 
+                list(names_to_levels_ids), 
                 scorer=rapidfuzz.fuzz.WRatio,
+                score_cutoff=60,
                 limit=2
             )
+        if len(e) == 0:
+            logging.error("unknown city and nothing similar found, please rerun")
+            return 1
         ql = [x[0] for x in e]
         print(f"unknown, maybe you meant one of these? {ql}")
         q= 'n'
@@ -396,7 +507,7 @@ def main():
         state_index = 0
     if state_index < 1:
         gdf = c.get_gdf_sqlite(city_id=city_id)
-        #gdf = c.get_gdf()
+        #gdf = c.get_gdf(city_id=city_id)
         c.extract_city(city_name, gdf)
     else:
         c.load_cached_mp(city_name)
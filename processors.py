@@ -12,14 +12,17 @@ python version 3.12
 # Standard Python modules
 # =============================================================================
 import logging
-from typing import Dict, Literal, override
+from typing import Dict, List, Literal, Tuple, override
 from collections import defaultdict, Counter
 import sqlite3
 
 # =============================================================================
 # External Python modules
 # =============================================================================
+import geopandas as gpd
 import numpy as np
+import pandas as pd
+import shapely
 
 # =============================================================================
 # Extension modules
@@ -31,33 +34,21 @@ import numpy as np
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.DEBUG)
 
 
-def has_value(v) -> bool:
-    """ helper to avoid different kinds of empty fields
-    """
-    if v is None:
-        return False
-    # pandas NA / numpy nan
-    try:
-        if np.isnan(v):
-            return False
-    except Exception:
-        pass
-    if isinstance(v, str) and v.strip().lower() in ["none", "null", ""]:
-        return False
-    return True
-
-
-def within_boundary_rtree(gpkg_path, table, geom_col, pk_col, boundary_id, spatialite_path="mod_spatialite"):
+def within_boundary_rtree(gpkg_path, table, geom_col, pk_col, boundary_id, select=None, spatialite_path="mod_spatialite"):
     """
     gpkg_path: path to the .gpkg
     table: the GeoPackage feature table name (often equals the layer name in Fiona/OGR, but not always)
     geom_col: geometry column name (often geom, sometimes geometry)
     pk_col: the primary key column in that table (often fid, id, etc.)
     boundary_id: the pk value of the boundary feature row
+    select: sql expressions to select from the table (aliased "t"), 
+        defaults to pk and name
     spatialite_path: the name/path of the SpatiaLite extension shared library (depends on OS)
 
-    Returns: list[pk, name]
+    Returns: list of tuples as selected, by default list[pk, name]
     """
+    if select is None:
+        select = [f"t.{pk_col}", "t.name"]
     rtree = f'rtree_{table}_{geom_col}'  # common GPKG naming
 
     con = sqlite3.connect(gpkg_path)
@@ -79,7 +70,7 @@ def within_boundary_rtree(gpkg_path, table, geom_col, pk_col, boundary_id, spati
       FROM "{table}"
       WHERE {pk_col} = ?
     )
-    SELECT t.{pk_col}, t.name
+    SELECT {", ".join(select)}
     FROM "{table}" t
     JOIN "{rtree}" r
       ON r.id = t.{pk_col}
@@ -93,6 +84,24 @@ def within_boundary_rtree(gpkg_path, table, geom_col, pk_col, boundary_id, spati
     return rows
 
 
+def gpkg_table_info(gpkg_path, table):
+    """ returns the column names of table and the crs of its geometry column 
+    (as "EPSG:xxxx" if possible, else the stored WKT)
+    """
+    with sqlite3.connect(gpkg_path) as con:
+        columns = [r[0] for r in con.execute(
+            "SELECT name FROM pragma_table_info(?)", (table,)
+        ).fetchall()]
+        org, org_id, definition = con.execute("""
+            SELECT s.organization, s.organization_coordsys_id, s.definition 
+            FROM gpkg_geometry_columns g
+            JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id
+            WHERE g.table_name = ?
+        """, (table,)).fetchone()
+    crs = f"EPSG:{org_id}" if str(org).upper() == "EPSG" else definition
+    return columns, crs
+
+
 
 class AbstractProcessor:
     def get_all_admin_boundaries(self, gdf):
@@ -101,7 +110,13 @@ class AbstractProcessor:
     def is_admin_level_subcity(self, gdf_row):
         raise NotImplementedError("overwrite in implementing class")
 
-    def fetch_boundaries_only(self, path_in, layers="multipolygons"):
+    def fetch_boundaries_only(self, path_in, layers="multipolygons", bbox=None):
+        raise NotImplementedError("overwrite in implementing class")
+
+    def fetch_multipolygons_within(self, path_in, city_id, layer="multipolygons"):
+        raise NotImplementedError("overwrite in implementing class")
+
+    def prepare_columns(self, gdf):
         raise NotImplementedError("overwrite in implementing class")
 
 ### OSM Processor plus some look ups
@@ -110,10 +125,39 @@ OSM_GREEN_LANDUSE = {"forest", "grass", "meadow", "recreation_ground", "village_
 OSM_GREEN_NATURAL = {"wood", "grassland", "heath", "scrub", "wetland"}
 # leisure/tourism is usually "special_use", but parks are "green" instead.
 OSM_GREEN_LEISURE = {"park", "garden", "nature_reserve"}
+#residential fairly low because the areas in my test set are very big
+OSM_USE_PRIORITY = [
+        "special_use", 
+        "economic", 
+        "water", 
+        "green", 
+        "residential", 
+        "building_only",
+        "null"
+]
+# stored as int8 codes instead of python strings
+OSM_USE_TYPES = pd.CategoricalDtype(OSM_USE_PRIORITY, ordered=True)
 
 class ProcessorOSM(AbstractProcessor):
     PK_COLUMN="fid"
     GEOM_COLUMN="geom"
+    # everything downstream needs, the other osm columns stay on disk. 
+    #   other_tags is only read to derive is_water from it (see prepare_columns)
+    USED_COLUMNS=[
+            "osm_id",
+            "osm_way_id",
+            "name",
+            "admin_level",
+            "boundary",
+            "amenity",
+            "leisure",
+            "tourism",
+            "public_transport",
+            "landuse",
+            "natural",
+            "building",
+            "other_tags",
+    ]
 
     @override
     def get_all_admin_boundaries(self, gdf):
@@ -125,7 +169,7 @@ class ProcessorOSM(AbstractProcessor):
     def set_subcity_admin_level(self, admin_boundaries_gdf, city_gdf):
         self.base_admin_level = city_gdf.iloc[0]['admin_level']
         valid = admin_boundaries_gdf[
-            admin_boundaries_gdf["admin_level"] > self.base_admin_level
+            (admin_boundaries_gdf["admin_level"] > self.base_admin_level).fillna(False)
         ]
         self.sub_admin_level = None
         if not valid.empty:
@@ -142,94 +186,148 @@ class ProcessorOSM(AbstractProcessor):
 
     @override
     def is_admin_level_subcity(self, gdf):
-        # super ugly hack for now with string comparison, whatever - osm data 
-        # is clean I hope...
-        return gdf['admin_level'].map(lambda x: str(x) == str(self.sub_admin_level))
+        # admin_level is an int already, see prepare_columns
+        return (gdf["admin_level"] == self.sub_admin_level).fillna(False).to_numpy(dtype=bool)
 
     @override
     def not_admin_boundary(self, gdf):
-        return gdf["boundary"].map(lambda x: x!= "administrative")
+        return (gdf["boundary"] != "administrative").to_numpy()
    
     def get_use_priority(self):
-        #residential fairly low because the areas in my test set are very big
-        return [
-                "special_use", 
-                "economic", 
-                "water", 
-                "green", 
-                "residential", 
-                "building_only",
-                "null"
-        ]
-
-    def classify_use(self, row) -> str:
-        amenity = row.get("amenity", None)
-        leisure = row.get("leisure", None)
-        tourism = row.get("tourism", None)
-        public_transport = row.get("public_transport", None)
-        landuse = row.get("landuse", None)
-        natural = row.get("natural", None)
-        building = row.get("building", None)
-        other_tags = row.get("other_tags", None)
-
-        # special_use 
-        if has_value(amenity) or has_value(public_transport) or has_value(tourism):
-            return "special_use"
+        return list(OSM_USE_PRIORITY)
+
+    @staticmethod
+    def _has_value_col(s) -> np.ndarray:
+        """ helper to avoid different kinds of empty fields, for a whole column
+        """
+        return (
+                s.notna().to_numpy() & 
+                ~s.astype(str).str.strip().str.lower().isin(["none", "null", ""]).to_numpy()
+        )
 
-        if has_value(landuse) and landuse == "cemetery":
-            return "special_use"
+    @staticmethod
+    def _other_tags_water(other_tags) -> np.ndarray:
+        return (
+                ProcessorOSM._has_value_col(other_tags) & 
+                other_tags.astype(str).str.contains("water", regex=False).to_numpy()
+        )
 
-        if has_value(leisure):
+    @override
+    def prepare_columns(self, gdf):
+        """ applied once to everything read from the input file
+
+        other_tags is a long hstore string and usually the biggest column,
+        but all we ever need from it is whether it mentions water.
+        admin_level becomes a small nullable int, so comparisons on it dont 
+        need any string conversion later on
+        """
+        if "other_tags" in gdf.columns:
+            gdf = gdf.assign(is_water=self._other_tags_water(gdf["other_tags"]))
+            gdf = gdf.drop(columns="other_tags")
+        if "admin_level" in gdf.columns:
+            # admin_level is a free text tag, junk values (non integer or out 
+            # of the int8 range) become NA instead of failing the cast
+            admin_level = pd.to_numeric(gdf["admin_level"], errors="coerce")
+            admin_level = admin_level.where((admin_level % 1 == 0) & admin_level.between(0, 127))
+            gdf = gdf.assign(admin_level=admin_level.astype("Int8"))
+        return gdf
+
+    def classify_use(self, gdf) -> pd.Categorical:
+        """ classifies all rows at once, returns the use types as categorical
+
+        conditions are listed in priority order, np.select picks the first 
+        one that matches per row
+        """
+        def _col(colname):
+            if colname in gdf.columns:
+                return gdf[colname]
+            return pd.Series(None, index=gdf.index, dtype=object)
+
+        amenity = _col("amenity")
+        leisure = _col("leisure")
+        tourism = _col("tourism")
+        public_transport = _col("public_transport")
+        landuse = _col("landuse")
+        natural = _col("natural")
+        building = _col("building")
+        # set by prepare_columns, missing if the input had no other_tags
+        is_water = _col("is_water").fillna(False).to_numpy(dtype=bool)
+
+        has_leisure = self._has_value_col(leisure)
+        has_landuse = self._has_value_col(landuse)
+        has_natural = self._has_value_col(natural)
+        leisure_str = leisure.astype(str).to_numpy()
+        landuse_str = landuse.astype(str).to_numpy()
+        natural_str = natural.astype(str).to_numpy()
+
+        conditions_choices = [
+            # special_use 
+            (
+                self._has_value_col(amenity) | 
+                self._has_value_col(public_transport) | 
+                self._has_value_col(tourism), 
+                "special_use"
+            ),
+            (has_landuse & (landuse_str == "cemetery"), "special_use"),
             # park/garden/nature_reserve is "green", the rest special_use
-            if str(leisure) in OSM_GREEN_LEISURE:
-                return "green"
-            return "special_use"
-
-        # economic
-        if has_value(landuse) and str(landuse) in OSM_ECON_LANDUSE:
-            return "economic"
-
-        # residential
-        if has_value(landuse) and str(landuse) == "residential":
-            return "residential"
-
-        # green
-        if has_value(natural) and str(natural) in OSM_GREEN_NATURAL:
-            return "green"
-        if has_value(landuse) and str(landuse) in OSM_GREEN_LANDUSE:
-            return "green"
-
-        # building_only
-        if has_value(building):
-            return "building_only"
-       
-        # water
-        if (
-                (has_value(other_tags) and "water" in other_tags) or 
-                (has_value(natural) and natural=="water")
-        ):
-            return "water"
-
+            (has_leisure & np.isin(leisure_str, list(OSM_GREEN_LEISURE)), "green"),
+            (has_leisure, "special_use"),
+            # economic
+            (has_landuse & np.isin(landuse_str, list(OSM_ECON_LANDUSE)), "economic"),
+            # residential
+            (has_landuse & (landuse_str == "residential"), "residential"),
+            # green
+            (has_natural & np.isin(natural_str, list(OSM_GREEN_NATURAL)), "green"),
+            (has_landuse & np.isin(landuse_str, list(OSM_GREEN_LANDUSE)), "green"),
+            # building_only
+            (self._has_value_col(building), "building_only"),
+            # water
+            (
+                is_water |
+                (has_natural & (natural_str == "water")),
+                "water"
+            ),
+        ]
         # null 
         # in my test set, these where mostly highways, memorials, bare rocks
         # and benches
-        #if row["boundary"]!= "administrative":
-        #    print(row)
-        return "null"
+        codes = np.select(
+                [c for c, _ in conditions_choices],
+                [OSM_USE_PRIORITY.index(u) for _, u in conditions_choices],
+                default=OSM_USE_PRIORITY.index("null")
+        ).astype(np.int8)
+        return pd.Categorical.from_codes(codes, dtype=OSM_USE_TYPES)
 
-    def fetch_boundaries_only(self, path_in, layer="multipolygons"):
+    @override
+    def fetch_boundaries_only(self, path_in, layer="multipolygons", bbox=None):
+        """ maps names of all administrative boundaries to (admin_level, pk)
+
+        bbox: (minx, miny, maxx, maxy) in the crs of the file, if given only 
+            boundaries intersecting it are fetched, using the gpkg rtree
+        """
         ret = defaultdict(list)
         with sqlite3.connect(path_in) as con:
             cur = con.cursor()
-            cur.execute("""
-                SELECT name, admin_level, fid FROM multipolygons 
-                WHERE boundary='administrative'
-            """)
+            if bbox is None:
+                cur.execute(f"""
+                    SELECT name, admin_level, {self.PK_COLUMN} FROM "{layer}" 
+                    WHERE boundary='administrative'
+                """)
+            else:
+                minx, miny, maxx, maxy = bbox
+                cur.execute(f"""
+                    SELECT t.name, t.admin_level, t.{self.PK_COLUMN} FROM "{layer}" t
+                    JOIN "rtree_{layer}_{self.GEOM_COLUMN}" r
+                      ON r.id = t.{self.PK_COLUMN}
+                    WHERE r.minx <= ? AND r.maxx >= ?
+                      AND r.miny <= ? AND r.maxy >= ?
+                      AND t.boundary='administrative'
+                """, (maxx, minx, maxy, miny))
             for r in cur.fetchall():
                 ret[r[0]].append((r[1], r[2]))
         return ret
 
-    def within_boundary_rtree(self, path_in, city_id, layer="multipolygons") -> List[int, str]:
+    def within_boundary_rtree(self, path_in, city_id, layer="multipolygons") -> List[Tuple[int, str]]:
         return within_boundary_rtree(
                 gpkg_path=path_in, 
                 table=layer, 
@@ -238,4 +336,32 @@ class ProcessorOSM(AbstractProcessor):
                 boundary_id=city_id,
         )
 
+    @override
+    def fetch_multipolygons_within(self, path_in, city_id, layer="multipolygons"):
+        """ all multipolygons covered by the boundary city_id, filtered inside 
+        sqlite so only those get deserialized
+        """
+        table_columns, crs = gpkg_table_info(path_in, layer)
+        columns = [c for c in self.USED_COLUMNS if c in table_columns and c != "other_tags"]
+        # quoted, "natural" is a sql keyword
+        select = [f't."{c}"' for c in columns]
+        if "other_tags" in table_columns:
+            # same as prepare_columns, but other_tags never even leaves sqlite
+            columns.append("is_water")
+            select.append("""COALESCE(instr(t."other_tags", 'water'), 0) > 0""")
+        select.append(f"AsBinary(t.{self.GEOM_COLUMN})")
+        rows = within_boundary_rtree(
+                gpkg_path=path_in, 
+                table=layer, 
+                geom_col=self.GEOM_COLUMN, 
+                pk_col=self.PK_COLUMN, 
+                boundary_id=city_id,
+                select=select,
+        )
+        df = pd.DataFrame.from_records(rows, columns=columns + ["wkb"])
+        if "is_water" in df.columns:
+            df["is_water"] = df["is_water"].astype(bool)
+        geometry = shapely.from_wkb(df.pop("wkb").to_numpy())
+        return self.prepare_columns(gpd.GeoDataFrame(df, geometry=geometry, crs=crs))
+
 